@@ -4,6 +4,7 @@ Compare two Go pprof CPU profiles and identify performance regressions.
 
 Usage:
     python compare_profiles.py <old_profile.pb.gz> <new_profile.pb.gz> [options]
+    python compare_profiles.py --batch <pairs.txt> [options]
 
 Options:
     --threshold PERCENT   Regression threshold percentage (default: 30)
@@ -11,6 +12,11 @@ Options:
     --exclude PATTERN     Exclude functions matching pattern (repeatable)
     --top N               Number of top entries per category (default: 20)
     --nodecount N         Number of nodes to extract from pprof (default: 300)
+    --decode              Decode profiles in Python instead of running `go tool pprof -top`
+                          (no go toolchain needed, but slower on large profiles)
+    --fast                Stop parsing pprof output once every category has enough candidates
+    --batch FILE          Compare every "OLD NEW" profile pair listed in FILE (one per line)
+    --no-cache            Don't read or write parse caches (<profile>.top<N>.json)
     --output FILE         Write results to file instead of stdout
 
 Examples:
@@ -18,21 +24,51 @@ Examples:
     python compare_profiles.py old.pb.gz new.pb.gz --threshold 20 --min-delta 100
     python compare_profiles.py old.pb.gz new.pb.gz --exclude "vector.*Path" --exclude "guioverworld"
     python compare_profiles.py old.pb.gz new.pb.gz --output results.txt
+    python compare_profiles.py --batch pairs.txt --output results.txt
 """
 
+import gzip
+import hashlib
+import io
+import json
+import os
 import subprocess
 import re
 import sys
+import tempfile
+import threading
+import zlib
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import attrgetter
+
+
+# Old vs new timings for a function present in both profiles
+Comparison = namedtuple(
+    "Comparison",
+    [
+        "name",
+        "category",
+        "old_flat",
+        "new_flat",
+        "flat_delta",
+        "flat_pct",
+        "old_cum",
+        "new_cum",
+        "cum_delta",
+        "cum_pct",
+    ],
+)
 
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Compare two Go pprof CPU profiles for regressions"
     )
-    parser.add_argument("old_profile", help="Path to the old/baseline .pb.gz profile")
-    parser.add_argument("new_profile", help="Path to the new .pb.gz profile")
+    parser.add_argument("old_profile", nargs="?", help="Path to the old/baseline .pb.gz profile")
+    parser.add_argument("new_profile", nargs="?", help="Path to the new .pb.gz profile")
     parser.add_argument(
         "--threshold",
         type=float,
@@ -63,14 +99,78 @@ def parse_args():
         default=300,
         help="Number of nodes to extract from pprof (default: 300)",
     )
+    parser.add_argument(
+        "--decode",
+        action="store_true",
+        help="Decode profiles in Python instead of running `go tool pprof -top`; "
+        "needs no go toolchain but is slower on large profiles",
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="Stop parsing pprof output once every category has enough candidates "
+        "(no effect with --decode)",
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        default=None,
+        help="Compare every 'OLD NEW' profile pair listed in this file (one per line)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write parse caches (<profile>.top<N>.json)",
+    )
     parser.add_argument(
         "--output", type=str, default=None, help="Write results to file"
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.batch is None and (args.old_profile is None or args.new_profile is None):
+        parser.error("old_profile and new_profile are required unless --batch is given")
+    # Compile once; batch mode checks every pair against the same patterns
+    try:
+        args.exclude = [re.compile(p) for p in args.exclude]
+    except re.error as e:
+        parser.error(f"invalid --exclude pattern {e.pattern!r}: {e}")
+    return args
+
+
+# Seconds a go tool pprof run, or one command in a PprofSession, may take
+_PPROF_TIMEOUT = 60
+
+
+class _Deadline:
+    """Context manager that kills a process if it outlives the timeout.
+
+    Streaming reads have no timeout of their own, so this bounds the whole
+    read-and-wait instead of just the final wait.
+    """
+
+    def __init__(self, proc, timeout):
+        self.expired = False
+        self._proc = proc
+        self._timer = threading.Timer(timeout, self._expire)
+        self._timer.daemon = True
+
+    def _expire(self):
+        self.expired = True
+        self._proc.kill()
 
+    def __enter__(self):
+        self._timer.start()
+        return self
 
-def run_pprof(profile_path, nodecount=300):
-    """Run go tool pprof and return raw output."""
+    def __exit__(self, *exc_info):
+        self._timer.cancel()
+
+
+def run_pprof(profile_path, stderr, nodecount=300):
+    """Start go tool pprof and return the process; its binary stdout streams the -top output.
+
+    stderr should be a file (not a pipe) so pprof can't block on output nobody
+    reads while stdout is being parsed.
+    """
     cmd = [
         "go",
         "tool",
@@ -79,40 +179,93 @@ def run_pprof(profile_path, nodecount=300):
         f"-nodecount={nodecount}",
         profile_path,
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-    if result.returncode != 0:
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+
+
+def wait_pprof(proc, profile_path, stderr, deadline):
+    """Wait for a go tool pprof process to finish and exit if it failed or timed out."""
+    proc.wait()
+    if deadline.expired:
+        print(f"Error running pprof on {profile_path}: timed out after {_PPROF_TIMEOUT}s", file=sys.stderr)
+        sys.exit(1)
+    if proc.returncode != 0:
+        stderr.seek(0)
         print(f"Error running pprof on {profile_path}:", file=sys.stderr)
-        print(result.stderr, file=sys.stderr)
+        print(stderr.read().decode("utf-8", "replace"), file=sys.stderr)
         sys.exit(1)
-    return result.stdout
 
 
-def parse_pprof_output(output):
-    """Parse pprof -top output into a dict of {function_name: (flat_ms, cum_ms)}."""
+# pprof -top header and row patterns
+_TOTAL_RE = re.compile(r"Total samples\s*=\s*([\d.]+)(ms|s)")
+_DURATION_RE = re.compile(r"Duration:\s*([\d.]+)s")
+# Format: flat flat% sum% cum cum% function_name
+# Example: 16141ms 37.92% 37.92% 16515ms 38.80%  runtime.cgocall
+_LINE_RE = re.compile(
+    r"^\s*([\d.]+)(ms|s)\s+[\d.]+%\s+[\d.]+%\s+([\d.]+)(ms|s)\s+[\d.]+%\s+(.+)$"
+)
+
+
+def _to_ms(value):
+    """Convert a pprof -top duration such as '16141ms', '1.5s' or a bare '0' to milliseconds."""
+    # pprof prints zero durations without a unit
+    if value == "0":
+        return 0.0
+    if value.endswith("ms"):
+        return float(value[:-2])
+    if value.endswith("s"):
+        return float(value[:-1]) * 1000
+    raise ValueError(f"unrecognized duration: {value}")
+
+
+def parse_pprof_output(lines, min_per_category=None):
+    """Parse pprof -top output lines into a dict of {function_name: (flat_ms, cum_ms)}.
+
+    With min_per_category (--fast), parsing stops once every category has that
+    many functions and the parsed flat time covers 95% of the total samples.
+    Also returns whether rows were left unparsed (truncated).
+    """
     functions = {}
     total_samples = None
+    duration = None
+    truncated = False
+    category_counts = dict.fromkeys(CATEGORIES, 0)
+    parsed_flat = 0.0
 
-    # Extract total samples from header
-    total_match = re.search(r"Total samples\s*=\s*([\d.]+)(ms|s)", output)
-    if total_match:
-        val = float(total_match.group(1))
-        unit = total_match.group(2)
-        total_samples = val if unit == "ms" else val * 1000
-
-    # Extract duration
-    duration_match = re.search(r"Duration:\s*([\d.]+)s", output)
-    duration = float(duration_match.group(1)) if duration_match else None
-
-    # Parse each function line
-    # Format: flat flat% sum% cum cum% function_name
-    # Example: 16141ms 37.92% 37.92% 16515ms 38.80%  runtime.cgocall
-    pattern = re.compile(
-        r"^\s*([\d.]+)(ms|s)\s+[\d.]+%\s+[\d.]+%\s+([\d.]+)(ms|s)\s+[\d.]+%\s+(.+)$"
-    )
+    lines = iter(lines)
+    for line in lines:
+        # Header lines precede the function rows
+        if not functions:
+            # Extract total samples from header
+            total_match = _TOTAL_RE.search(line)
+            if total_match:
+                val = float(total_match.group(1))
+                unit = total_match.group(2)
+                total_samples = val if unit == "ms" else val * 1000
+
+            # Extract duration
+            duration_match = _DURATION_RE.search(line)
+            if duration_match:
+                duration = float(duration_match.group(1))
 
-    for line in output.split("\n"):
-        m = pattern.match(line)
-        if m:
+        # Function rows carry an ms or s duration; skip everything else cheaply
+        if "ms" not in line and "s " not in line:
+            continue
+
+        func_name = None
+        parts = line.split(None, 5)
+        if len(parts) == 6 and parts[1].endswith("%") and parts[4].endswith("%"):
+            try:
+                flat_ms = _to_ms(parts[0])
+                cum_ms = _to_ms(parts[3])
+                func_name = parts[5].strip()
+            except ValueError:
+                pass
+
+        # Fall back to the full regex for rows the split parser can't handle
+        if func_name is None:
+            m = _LINE_RE.match(line)
+            if not m:
+                continue
             flat_val = float(m.group(1))
             flat_unit = m.group(2)
             cum_val = float(m.group(3))
@@ -122,19 +275,441 @@ def parse_pprof_output(output):
             flat_ms = flat_val if flat_unit == "ms" else flat_val * 1000
             cum_ms = cum_val if cum_unit == "ms" else cum_val * 1000
 
-            functions[func_name] = (flat_ms, cum_ms)
+        functions[func_name] = (flat_ms, cum_ms)
+
+        # -top rows are sorted by flat, so the remaining rows are the smallest
+        if min_per_category:
+            category_counts[categorize_function(func_name)] += 1
+            parsed_flat += flat_ms
+            if (
+                total_samples
+                and parsed_flat > 0.95 * total_samples
+                and min(category_counts.values()) >= min_per_category
+            ):
+                truncated = bool(next(lines, "").strip())
+                break
+
+    return functions, total_samples, duration, truncated
+
+
+# Prompt printed by interactive go tool pprof when it is ready for a command
+_PPROF_PROMPT = b"(pprof) "
+
+
+class PprofSession:
+    """A long-lived interactive go tool pprof process for one profile.
+
+    Used in batch mode so a profile that appears in several pairs is loaded
+    and symbolized by pprof once, and each comparison just issues `top`.
+    """
+
+    def __init__(self, profile_path):
+        self.profile_path = profile_path
+        self.proc = subprocess.Popen(
+            ["go", "tool", "pprof", profile_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        # The banner (Duration, Total samples, ...) precedes the first prompt
+        self.header = self._read_response().splitlines()
+
+    def _read_response(self):
+        """Read pprof output up to the next prompt; exit if pprof terminated or hung instead."""
+        buf = bytearray()
+        with _Deadline(self.proc, _PPROF_TIMEOUT) as deadline:
+            while not buf.endswith(_PPROF_PROMPT):
+                chunk = self.proc.stdout.read1(1 << 16)
+                if not chunk:
+                    break
+                buf += chunk
+        if not buf.endswith(_PPROF_PROMPT):
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc.stdout.close()
+            if deadline.expired:
+                print(f"Error running pprof on {self.profile_path}: timed out after {_PPROF_TIMEOUT}s", file=sys.stderr)
+            else:
+                print(f"Error running pprof on {self.profile_path}:", file=sys.stderr)
+                print(buf.decode("utf-8", "replace"), file=sys.stderr)
+            sys.exit(1)
+        return buf[: -len(_PPROF_PROMPT)].decode("utf-8", "replace")
+
+    def top(self, nodecount, min_per_category=None):
+        """Run `top` in the session and parse it like parse_pprof_output."""
+        self.proc.stdin.write(f"top {nodecount}\n".encode())
+        self.proc.stdin.flush()
+        lines = self.header + self._read_response().splitlines()
+        return parse_pprof_output(lines, min_per_category)
+
+    def close(self):
+        """Ask pprof to quit and wait for it to exit."""
+        try:
+            self.proc.stdin.write(b"quit\n")
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+# Conversion factors from pprof sample units to milliseconds
+_UNIT_TO_MS = {
+    "nanoseconds": 1e-6,
+    "microseconds": 1e-3,
+    "milliseconds": 1.0,
+    "seconds": 1000.0,
+}
+
+
+# pprof's default -nodefraction: -top keeps functions whose cum is at least this
+# share of the total, truncated to a whole sample value
+_NODE_FRACTION = 0.005
+
+
+def _read_varint(buf, pos):
+    """Decode a protobuf varint at pos, returning (value, new_pos)."""
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf):
+    """Yield (field_number, wire_type, value) for each field of a protobuf message."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = buf[pos : pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos : pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos : pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire_type}")
+        yield key >> 3, wire_type, value
+
+
+def _repeated_varints(wire_type, value):
+    """Decode a repeated varint field that may be packed or unpacked."""
+    if wire_type == 0:
+        return [value]
+    values = []
+    pos = 0
+    end = len(value)
+    while pos < end:
+        v, pos = _read_varint(value, pos)
+        values.append(v)
+    return values
+
+
+# Profile fields that are length-delimited (sample_type, sample, location, function, string_table)
+_MESSAGE_FIELDS = frozenset((1, 2, 4, 5, 6))
+
+
+def _decode_profile(data):
+    """Decode the parts of a profile.proto Profile message needed for -top style output."""
+    strings = []
+    sample_types = []  # (type string index, unit string index)
+    raw_samples = []
+    locations = {}  # location id -> [function id, ...] (leaf first, including inlined frames)
+    function_names = {}  # function id -> name string index
+    duration_nanos = 0
+    default_sample_type = 0
+
+    for field, wire_type, value in _iter_fields(data):
+        if field in _MESSAGE_FIELDS and wire_type != 2:
+            raise ValueError(f"profile field {field} has wire type {wire_type}, expected 2")
+        if field == 2:  # sample
+            raw_samples.append(value)
+        elif field == 4:  # location
+            loc_id = 0
+            func_ids = []
+            for f, _, v in _iter_fields(value):
+                if f == 1:
+                    loc_id = v
+                elif f == 4:  # line
+                    for lf, _, lv in _iter_fields(v):
+                        if lf == 1:
+                            func_ids.append(lv)
+            locations[loc_id] = func_ids
+        elif field == 5:  # function
+            func_id = 0
+            name_idx = 0
+            for f, _, v in _iter_fields(value):
+                if f == 1:
+                    func_id = v
+                elif f == 2:
+                    name_idx = v
+            function_names[func_id] = name_idx
+        elif field == 6:  # string_table
+            strings.append(bytes(value).decode("utf-8", "replace"))
+        elif field == 1:  # sample_type
+            type_idx = 0
+            unit_idx = 0
+            for f, _, v in _iter_fields(value):
+                if f == 1:
+                    type_idx = v
+                elif f == 2:
+                    unit_idx = v
+            sample_types.append((type_idx, unit_idx))
+        elif field == 10:  # duration_nanos
+            duration_nanos = value
+        elif field == 14:  # default_sample_type
+            default_sample_type = value
+
+    return strings, sample_types, raw_samples, locations, function_names, duration_nanos, default_sample_type
+
+
+def parse_pprof_proto(profile_path, nodecount=300):
+    """Decode a .pb.gz profile directly into {function_name: (flat_ms, cum_ms)}.
+
+    Mirrors go tool pprof -top: flat is charged to the leaf frame of each
+    sample and cum to every distinct function on the stack. Functions with cum
+    below pprof's default node fraction are dropped, and the top
+    `nodecount` are kept by flat, ties broken by name. The one difference from
+    parse_pprof_output is naming: pprof marks inlined-only functions with an
+    " (inline)" suffix, the decoder reports the plain function name. The
+    decoder always reads every sample, so it never reports truncation.
+    """
+    try:
+        with open(profile_path, "rb") as f:
+            data = f.read()
+        if data[:2] == b"\x1f\x8b":
+            data = gzip.decompress(data)
+        return _summarize_profile(_decode_profile(memoryview(data)), nodecount)
+    except (OSError, EOFError, zlib.error, ValueError, IndexError, KeyError, TypeError) as e:
+        # Truncated or corrupt profiles surface as any of these while decoding or
+        # resolving string, function and location references
+        print(f"Error decoding profile {profile_path}: {e!r}", file=sys.stderr)
+        sys.exit(1)
+
+
+def _summarize_profile(decoded, nodecount):
+    """Aggregate a _decode_profile result into parse_pprof_proto's return value."""
+    (
+        strings,
+        sample_types,
+        raw_samples,
+        locations,
+        function_names,
+        duration_nanos,
+        default_sample_type,
+    ) = decoded
 
-    return functions, total_samples, duration
+    if not sample_types:
+        return {}, None, None
+
+    # Pick the value pprof reports by default: default_sample_type, else the last one
+    value_index = len(sample_types) - 1
+    if default_sample_type:
+        for i, (type_idx, _) in enumerate(sample_types):
+            if type_idx == default_sample_type:
+                value_index = i
+                break
+    unit = strings[sample_types[value_index][1]]
+    scale = _UNIT_TO_MS.get(unit, 1.0)
+
+    # Give every distinct function name a dense index so samples accumulate
+    # into flat lists rather than name-keyed dicts.
+    func_names = []
+    name_to_index = {}
+    func_index = {}  # function id -> dense index
+    for func_id, name_idx in function_names.items():
+        name = strings[name_idx]
+        idx = name_to_index.get(name)
+        if idx is None:
+            idx = name_to_index[name] = len(func_names)
+            func_names.append(name)
+        func_index[func_id] = idx
+
+    # Location IDs are small sequential ints in Go profiles, so index a dense
+    # list instead of hashing; fall back to the dict for sparse IDs.
+    max_loc_id = max(locations, default=0)
+    if max_loc_id <= 4 * len(locations) + 1024:
+        loc_frames = [()] * (max_loc_id + 1)
+    else:
+        loc_frames = {}
+    for loc_id, func_ids in locations.items():
+        loc_frames[loc_id] = tuple(func_index[fid] for fid in func_ids if fid in func_index)
+
+    flat = [0] * len(func_names)
+    cum = [0] * len(func_names)
+    total = 0
+    for raw in raw_samples:
+        loc_ids = []
+        values = []
+        for f, wire_type, v in _iter_fields(raw):
+            if f == 1:
+                loc_ids.extend(_repeated_varints(wire_type, v))
+            elif f == 2:
+                values.extend(_repeated_varints(wire_type, v))
+        value = values[value_index] if value_index < len(values) else 0
+        if not value:
+            continue
+        total += value
+
+        stack = []
+        for loc_id in loc_ids:
+            stack.extend(loc_frames[loc_id])
+        if not stack:
+            continue
+        flat[stack[0]] += value
+        for idx in set(stack):
+            cum[idx] += value
+
+    # Like -top, drop functions below pprof's default node fraction; cum is 0
+    # only for functions no sample reached, which pprof never lists
+    min_cum = int(total * _NODE_FRACTION)
+    ranked = sorted(
+        (i for i, c in enumerate(cum) if c and c >= min_cum),
+        key=lambda i: (-flat[i], func_names[i], -cum[i]),
+    )[:nodecount]
+    functions = {func_names[i]: (flat[i] * scale, cum[i] * scale) for i in ranked}
+    total_samples = total * scale
+    duration = duration_nanos / 1e9 if duration_nanos else None
+    return functions, total_samples, duration, False
+
+
+def profile_cache_path(profile_path, nodecount):
+    """Path of the parse cache kept next to a profile; nodecount is part of the key."""
+    return f"{profile_path}.top{nodecount}.json"
+
+
+def _profile_stamp(profile_path):
+    """Size and mtime identifying the profile contents a cache was built from."""
+    st = os.stat(profile_path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_cached_profile(cache_path, profile_path, parser):
+    """Return a cached load_profile result, or None if missing or stale."""
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["parser"] != parser or cached["stamp"] != _profile_stamp(profile_path):
+            return None
+        functions = {name: tuple(times) for name, times in cached["functions"].items()}
+        return functions, cached["total_samples"], cached["duration"], cached["truncated"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_cached_profile(cache_path, profile_path, parser, result):
+    """Save a load_profile result next to the profile; caching is skipped if that fails."""
+    functions, total_samples, duration, truncated = result
+    tmp_path = cache_path + ".tmp"
+    try:
+        cached = {
+            "parser": parser,
+            "stamp": _profile_stamp(profile_path),
+            "functions": functions,
+            "total_samples": total_samples,
+            "duration": duration,
+            "truncated": truncated,
+        }
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cached, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+
+def load_profile(profile_path, args, sessions=None):
+    """Extract {function_name: (flat_ms, cum_ms)}, total samples, duration and --fast truncation.
+
+    Results are cached next to the profile unless --no-cache is given. When a
+    sessions dict is passed (batch mode with --no-cache), the profile's
+    PprofSession is reused, or started on first use.
+    """
+    parser = "proto" if args.decode else "pprof"
+    min_per_category = None
+    if args.fast and not args.decode:
+        # Early-exit results are partial and depend on --top, so key the cache on both
+        min_per_category = args.top * _FAST_CANDIDATE_SLACK
+        parser = f"pprof-fast{min_per_category}"
+    cache_path = None if args.no_cache else profile_cache_path(profile_path, args.nodecount)
+    if cache_path:
+        cached = read_cached_profile(cache_path, profile_path, parser)
+        if cached is not None:
+            return cached
+
+    if sessions is not None:
+        if profile_path not in sessions:
+            sessions[profile_path] = PprofSession(profile_path)
+        result = sessions[profile_path].top(args.nodecount, min_per_category)
+    elif args.decode:
+        result = parse_pprof_proto(profile_path, args.nodecount)
+    else:
+        with tempfile.TemporaryFile() as stderr, run_pprof(profile_path, stderr, args.nodecount) as proc:
+            with _Deadline(proc, _PPROF_TIMEOUT) as deadline:
+                # Decode incrementally so parsing starts before pprof finishes writing
+                lines = io.TextIOWrapper(proc.stdout, encoding="utf-8", errors="replace", newline="\n")
+                result = parse_pprof_output(lines, min_per_category)
+                if result[3]:
+                    # --fast stopped before the end; the rest of pprof's output isn't needed
+                    proc.kill()
+                    proc.wait()
+                else:
+                    wait_pprof(proc, profile_path, stderr, deadline)
+
+    if cache_path:
+        write_cached_profile(cache_path, profile_path, parser, result)
+    return result
+
+
+def _file_digest(path):
+    """Hash a file's contents in chunks."""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def profiles_identical(old_path, new_path):
+    """Check if both paths hold byte-identical profiles."""
+    try:
+        if os.path.samefile(old_path, new_path):
+            return True
+        if os.path.getsize(old_path) != os.path.getsize(new_path):
+            return False
+        return _file_digest(old_path) == _file_digest(new_path)
+    except OSError:
+        return False
 
 
 def should_exclude(func_name, exclude_patterns):
-    """Check if function matches any exclusion pattern."""
+    """Check if function matches any precompiled exclusion pattern."""
     for pattern in exclude_patterns:
-        if re.search(pattern, func_name):
+        if pattern.search(func_name):
             return True
     return False
 
 
+# Report categories, in display order
+CATEGORIES = ["YOUR_CODE", "ECS", "RUNTIME", "EBITEN", "OTHER"]
+
+# With --fast, parse until every category has --top times this many functions,
+# leaving slack for the ones threshold filtering will drop
+_FAST_CANDIDATE_SLACK = 5
+
+
+@lru_cache(maxsize=None)
 def categorize_function(func_name):
     """Categorize a function into a group."""
     if func_name.startswith("game_main/"):
@@ -151,31 +726,35 @@ def categorize_function(func_name):
 
 def format_ms(ms):
     """Format milliseconds for display."""
-    if ms >= 1000:
-        return f"{ms:,.0f}ms"
-    return f"{ms:.0f}ms"
+    return f"{ms:,.0f}ms"
 
 
 def format_change(old_val, new_val):
     """Format percentage change."""
+    if old_val == new_val:
+        return "0%"
     if old_val == 0:
-        if new_val == 0:
-            return "0%"
         return "+NEW"
     pct = ((new_val - old_val) / old_val) * 100
-    sign = "+" if pct > 0 else ""
-    return f"{sign}{pct:.0f}%"
+    return f"{pct:+.0f}%"
+
 
+# Common prefixes removed or abbreviated for display
+_SHORTEN_MAP = {
+    "game_main/": "",
+    "github.com/hajimehoshi/ebiten/v2/": "ebiten/",
+    "github.com/ebitenui/ebitenui/": "ebitenui/",
+    "github.com/bytearena/ecs.": "ecs.",
+    "github.com/golang/freetype/": "freetype/",
+    "golang.org/x/sys/windows.": "windows.",
+}
+_SHORTEN_RE = re.compile("|".join(re.escape(k) for k in _SHORTEN_MAP))
 
+
+@lru_cache(maxsize=None)
 def shorten_func(name, max_len=55):
     """Shorten function name for display."""
-    # Remove common prefixes
-    name = name.replace("game_main/", "")
-    name = name.replace("github.com/hajimehoshi/ebiten/v2/", "ebiten/")
-    name = name.replace("github.com/ebitenui/ebitenui/", "ebitenui/")
-    name = name.replace("github.com/bytearena/ecs.", "ecs.")
-    name = name.replace("github.com/golang/freetype/", "freetype/")
-    name = name.replace("golang.org/x/sys/windows.", "windows.")
+    name = _SHORTEN_RE.sub(lambda m: _SHORTEN_MAP[m.group(0)], name)
 
     if len(name) > max_len:
         name = name[: max_len - 3] + "..."
@@ -188,49 +767,130 @@ def print_table(headers, rows, out):
         out.write("  (none)\n")
         return
 
-    col_widths = [len(h) for h in headers]
-    for row in rows:
-        for i, cell in enumerate(row):
-            col_widths[i] = max(col_widths[i], len(str(cell)))
+    # Stringify each cell once, then size columns from the cached strings
+    str_rows = [[cell if isinstance(cell, str) else str(cell) for cell in row] for row in rows]
+    col_widths = [max(len(h), *(len(r[i]) for r in str_rows)) for i, h in enumerate(headers)]
+    row_format = "  " + " | ".join(f"{{:<{w}}}" for w in col_widths) + "\n"
 
     # Header
-    header_line = " | ".join(h.ljust(col_widths[i]) for i, h in enumerate(headers))
-    out.write(f"  {header_line}\n")
-    sep_line = "-+-".join("-" * col_widths[i] for i in range(len(headers)))
-    out.write(f"  {sep_line}\n")
+    lines = [row_format.format(*headers)]
+    sep_line = "-+-".join("-" * w for w in col_widths)
+    lines.append(f"  {sep_line}\n")
 
     # Rows
-    for row in rows:
-        row_line = " | ".join(
-            str(cell).ljust(col_widths[i]) for i, cell in enumerate(row)
-        )
-        out.write(f"  {row_line}\n")
+    lines.extend(row_format.format(*row) for row in str_rows)
+    out.write("".join(lines))
 
 
-def main():
-    args = parse_args()
+# Buffer size for writing the finished report
+_OUTPUT_BUFFER_SIZE = 1 << 20
+
+
+def write_report(report, output_path):
+    """Write the finished report to output_path, or to stdout if not given."""
+    if output_path:
+        with open(output_path, "w", encoding="utf-8", buffering=_OUTPUT_BUFFER_SIZE) as f:
+            f.write(report)
+        print(f"Results written to {output_path}", file=sys.stderr)
+    else:
+        # Force UTF-8 on Windows to support box-drawing characters. The large
+        # buffer keeps the report to one write; per-call console writes are slow.
+        raw = open(sys.stdout.fileno(), "wb", buffering=_OUTPUT_BUFFER_SIZE, closefd=False)
+        with io.TextIOWrapper(raw, encoding="utf-8", write_through=False, line_buffering=False) as stdout:
+            stdout.write(report)
+
+
+def read_batch_file(path):
+    """Read (old, new) profile pairs: one whitespace-separated pair per line, # for comments."""
+    pairs = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            if len(parts) != 2:
+                print(f"{path}:{lineno}: expected 'OLD NEW', got: {line}", file=sys.stderr)
+                sys.exit(1)
+            pairs.append((parts[0], parts[1]))
+    return pairs
+
+
+def run_batch(args):
+    """Compare every pair in args.batch and return the concatenated reports.
 
-    # Extract profiles
-    print(f"Extracting profile: {args.old_profile} ...", file=sys.stderr)
-    old_output = run_pprof(args.old_profile, args.nodecount)
-    old_funcs, old_total, old_duration = parse_pprof_output(old_output)
+    With --no-cache, each distinct profile gets one PprofSession that answers
+    every pair using it and is closed after the last one. Otherwise each
+    profile is extracted once, through the cache, and reused.
+    """
+    pairs = read_batch_file(args.batch)
+    remaining = Counter(path for pair in pairs for path in pair)
+    sessions = {}
+    loaded = {}
 
-    print(f"Extracting profile: {args.new_profile} ...", file=sys.stderr)
-    new_output = run_pprof(args.new_profile, args.nodecount)
-    new_funcs, new_total, new_duration = parse_pprof_output(new_output)
+    def load(path):
+        if args.no_cache and not args.decode:
+            return load_profile(path, args, sessions)
+        if path not in loaded:
+            loaded[path] = load_profile(path, args)
+        return loaded[path]
 
-    # Find common functions (excluding patterns)
-    common_names = set(old_funcs.keys()) & set(new_funcs.keys())
+    reports = []
+    try:
+        for old, new in pairs:
+            reports.append(compare(old, new, args, load))
+            for path in (old, new):
+                remaining[path] -= 1
+                if not remaining[path] and path in sessions:
+                    sessions.pop(path).close()
+    finally:
+        for session in sessions.values():
+            session.close()
+    return "\n".join(reports)
+
+
+def compare(old_profile, new_profile, args, load):
+    """Compare two profiles and return the report text; load(path) extracts a profile."""
+    # Comparing a profile against itself can't find anything; skip extraction
+    if profiles_identical(old_profile, new_profile):
+        out = io.StringIO()
+        out.write("=" * 80 + "\n")
+        out.write("PPROF BENCHMARK COMPARISON\n")
+        out.write("=" * 80 + "\n\n")
+        out.write(f"Old profile: {old_profile}\n")
+        out.write(f"New profile: {new_profile}\n")
+        out.write("\nProfiles are identical: no regressions or improvements.\n")
+        out.write(f"\n{'=' * 80}\n")
+        return out.getvalue()
+
+    # Extract both profiles concurrently; the go tool pprof subprocesses are independent
+    print(f"Extracting profile: {old_profile} ...", file=sys.stderr)
+    print(f"Extracting profile: {new_profile} ...", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        old_future = pool.submit(load, old_profile)
+        new_future = pool.submit(load, new_profile)
+        old_funcs, old_total, old_duration, old_truncated = old_future.result()
+        new_funcs, new_total, new_duration, new_truncated = new_future.result()
+
+    # Find common functions (excluding patterns); every name is checked once.
+    # Dict key views support set algebra directly, so no temporary key sets.
+    old_names = old_funcs.keys()
+    new_names = new_funcs.keys()
     excluded = set()
-    for name in list(common_names):
-        if should_exclude(name, args.exclude):
-            excluded.add(name)
-            common_names.discard(name)
+    if args.exclude:
+        excluded = {n for n in old_names | new_names if should_exclude(n, args.exclude)}
+    shared_names = old_names & new_names
+    common_names = shared_names - excluded
 
-    # Build comparison data
-    regressions = []  # (func, category, old_flat, new_flat, flat_delta, flat_pct, old_cum, new_cum, cum_delta, cum_pct)
-    improvements = []
-    stable = []
+    # Build comparison data, bucketed by category
+    regressions = defaultdict(list)  # category -> [Comparison]
+    improvements = defaultdict(list)
+    stable_count = 0
+
+    # Thresholds are fixed for the whole loop; bind them once
+    threshold = args.threshold
+    neg_threshold = -threshold
+    min_delta = args.min_delta
 
     for name in common_names:
         old_flat, old_cum = old_funcs[name]
@@ -239,46 +899,47 @@ def main():
         flat_delta = new_flat - old_flat
         cum_delta = new_cum - old_cum
 
+        # Changes within min_delta are stable whatever their percentage
+        cum_moved = abs(cum_delta) > min_delta
+        flat_moved = abs(flat_delta) > min_delta
+        if not (cum_moved or flat_moved):
+            stable_count += 1
+            continue
+
         flat_pct = ((flat_delta / old_flat) * 100) if old_flat > 0 else (100 if new_flat > 0 else 0)
         cum_pct = ((cum_delta / old_cum) * 100) if old_cum > 0 else (100 if new_cum > 0 else 0)
 
-        category = categorize_function(name)
-        entry = (name, category, old_flat, new_flat, flat_delta, flat_pct, old_cum, new_cum, cum_delta, cum_pct)
-
         # Classify based on cumulative time change (primary) or flat time change
-        is_regression = (
-            (cum_pct > args.threshold and abs(cum_delta) > args.min_delta)
-            or (flat_pct > args.threshold and abs(flat_delta) > args.min_delta)
-        )
-        is_improvement = (
-            (cum_pct < -args.threshold and abs(cum_delta) > args.min_delta)
-            or (flat_pct < -args.threshold and abs(flat_delta) > args.min_delta)
-        )
-
-        if is_regression:
-            regressions.append(entry)
-        elif is_improvement:
-            improvements.append(entry)
+        if (cum_moved and cum_pct > threshold) or (flat_moved and flat_pct > threshold):
+            bucket = regressions
+        elif (cum_moved and cum_pct < neg_threshold) or (flat_moved and flat_pct < neg_threshold):
+            bucket = improvements
         else:
-            stable.append(entry)
+            stable_count += 1
+            continue
 
-    # Sort by cumulative delta descending
-    regressions.sort(key=lambda x: x[8], reverse=True)
-    improvements.sort(key=lambda x: x[8])
+        category = categorize_function(name)
+        bucket[category].append(
+            Comparison(name, category, old_flat, new_flat, flat_delta, flat_pct, old_cum, new_cum, cum_delta, cum_pct)
+        )
 
-    # Output
-    if args.output:
-        out = open(args.output, "w", encoding="utf-8")
-    else:
-        # Force UTF-8 on Windows to support box-drawing characters
-        out = open(sys.stdout.fileno(), "w", encoding="utf-8", closefd=False)
+    # Sort each category by cumulative delta (largest regressions / improvements first)
+    for cat_regressions in regressions.values():
+        cat_regressions.sort(key=attrgetter("cum_delta"), reverse=True)
+    for cat_improvements in improvements.values():
+        cat_improvements.sort(key=attrgetter("cum_delta"))
+    regression_count = sum(len(r) for r in regressions.values())
+    improvement_count = sum(len(r) for r in improvements.values())
+
+    # Output is assembled in memory and written out in one go at the end
+    out = io.StringIO()
 
     out.write("=" * 80 + "\n")
     out.write("PPROF BENCHMARK COMPARISON\n")
     out.write("=" * 80 + "\n\n")
 
-    out.write(f"Old profile: {args.old_profile}\n")
-    out.write(f"New profile: {args.new_profile}\n")
+    out.write(f"Old profile: {old_profile}\n")
+    out.write(f"New profile: {new_profile}\n")
     if old_duration:
         out.write(f"Old duration: {old_duration:.1f}s\n")
     if new_duration:
@@ -291,16 +952,15 @@ def main():
         out.write(f"Total sample delta: {format_ms(total_delta)} ({format_change(old_total, new_total)})\n")
 
     out.write(f"\nCommon functions compared: {len(common_names)}\n")
-    out.write(f"Excluded by patterns: {len(excluded)}\n")
+    out.write(f"Excluded by patterns: {len(shared_names) - len(common_names)}\n")
     out.write(f"Regression threshold: >{args.threshold}% and >{args.min_delta}ms delta\n")
-    out.write(f"Regressions found: {len(regressions)}\n")
-    out.write(f"Improvements found: {len(improvements)}\n")
-    out.write(f"Stable: {len(stable)}\n")
+    out.write(f"Regressions found: {regression_count}\n")
+    out.write(f"Improvements found: {improvement_count}\n")
+    out.write(f"Stable: {stable_count}\n")
 
     # --- Regressions by category ---
-    categories = ["YOUR_CODE", "ECS", "RUNTIME", "EBITEN", "OTHER"]
-    for cat in categories:
-        cat_regressions = [r for r in regressions if r[1] == cat]
+    for cat in CATEGORIES:
+        cat_regressions = regressions.get(cat)
         if not cat_regressions:
             continue
 
@@ -311,22 +971,21 @@ def main():
         headers = ["Function", "Old Flat", "New Flat", "Flat Chg", "Old Cum", "New Cum", "Cum Chg"]
         rows = []
         for entry in cat_regressions[: args.top]:
-            name, _, old_flat, new_flat, flat_delta, flat_pct, old_cum, new_cum, cum_delta, cum_pct = entry
             rows.append([
-                shorten_func(name),
-                format_ms(old_flat),
-                format_ms(new_flat),
-                format_change(old_flat, new_flat),
-                format_ms(old_cum),
-                format_ms(new_cum),
-                format_change(old_cum, new_cum),
+                shorten_func(entry.name),
+                format_ms(entry.old_flat),
+                format_ms(entry.new_flat),
+                format_change(entry.old_flat, entry.new_flat),
+                format_ms(entry.old_cum),
+                format_ms(entry.new_cum),
+                format_change(entry.old_cum, entry.new_cum),
             ])
         print_table(headers, rows, out)
 
     # --- Improvements by category ---
     has_improvements = False
-    for cat in categories:
-        cat_improvements = [r for r in improvements if r[1] == cat]
+    for cat in CATEGORIES:
+        cat_improvements = improvements.get(cat)
         if not cat_improvements:
             continue
         if not has_improvements:
@@ -339,30 +998,31 @@ def main():
         headers = ["Function", "Old Flat", "New Flat", "Flat Chg", "Old Cum", "New Cum", "Cum Chg"]
         rows = []
         for entry in cat_improvements[: args.top]:
-            name, _, old_flat, new_flat, flat_delta, flat_pct, old_cum, new_cum, cum_delta, cum_pct = entry
             rows.append([
-                shorten_func(name),
-                format_ms(old_flat),
-                format_ms(new_flat),
-                format_change(old_flat, new_flat),
-                format_ms(old_cum),
-                format_ms(new_cum),
-                format_change(old_cum, new_cum),
+                shorten_func(entry.name),
+                format_ms(entry.old_flat),
+                format_ms(entry.new_flat),
+                format_change(entry.old_flat, entry.new_flat),
+                format_ms(entry.old_cum),
+                format_ms(entry.new_cum),
+                format_change(entry.old_cum, entry.new_cum),
             ])
         print_table(headers, rows, out)
 
     # --- Summary of new-only functions (in new but not old) ---
-    new_only = set(new_funcs.keys()) - set(old_funcs.keys()) - excluded
+    new_only = new_names - old_names - excluded
     new_only_filtered = []
     for name in new_only:
-        if should_exclude(name, args.exclude):
-            continue
         _, cum = new_funcs[name]
         if cum > 200:  # Only show significant new functions
             new_only_filtered.append((name, new_funcs[name][0], cum))
     new_only_filtered.sort(key=lambda x: x[2], reverse=True)
 
-    if new_only_filtered:
+    # --fast leaves the old profile's small functions unparsed, so absence
+    # from it no longer means a function is new
+    if old_truncated:
+        out.write(f"\nNEW FUNCTIONS skipped: --fast stopped parsing the old profile early\n")
+    elif new_only_filtered:
         out.write(f"\n{'─' * 80}\n")
         out.write(f"NEW FUNCTIONS (not in old profile, cum > 200ms)\n")
         out.write(f"{'─' * 80}\n")
@@ -371,17 +1031,17 @@ def main():
         print_table(headers, rows, out)
 
     # --- Functions removed (in old but not new) ---
-    old_only = set(old_funcs.keys()) - set(new_funcs.keys()) - excluded
+    old_only = old_names - new_names - excluded
     old_only_filtered = []
     for name in old_only:
-        if should_exclude(name, args.exclude):
-            continue
         _, cum = old_funcs[name]
         if cum > 200:
             old_only_filtered.append((name, old_funcs[name][0], cum))
     old_only_filtered.sort(key=lambda x: x[2], reverse=True)
 
-    if old_only_filtered:
+    if new_truncated:
+        out.write(f"\nREMOVED FUNCTIONS skipped: --fast stopped parsing the new profile early\n")
+    elif old_only_filtered:
         out.write(f"\n{'─' * 80}\n")
         out.write(f"REMOVED FUNCTIONS (in old profile only, cum > 200ms)\n")
         out.write(f"{'─' * 80}\n")
@@ -391,9 +1051,17 @@ def main():
 
     out.write(f"\n{'=' * 80}\n")
 
-    if args.output:
-        out.close()
-        print(f"Results written to {args.output}", file=sys.stderr)
+    return out.getvalue()
+
+
+def main():
+    args = parse_args()
+
+    if args.batch:
+        report = run_batch(args)
+    else:
+        report = compare(args.old_profile, args.new_profile, args, lambda path: load_profile(path, args))
+    write_report(report, args.output)
 
 
 if __name__ == "__main__":